@@ -1,18 +1,97 @@
 from dataclasses import dataclass
-from abc import ABC
+from typing import ClassVar, List, Tuple
+import struct
 
-class DriverMessage(ABC):
-    pass
+# Tags identifying each type of DriverMessage on the wire.
+ACK = 0
+CHECKPOINT_CREATED = 1
+CHECKPOINT_RESTORED = 2
+CHECKPOINTS_CREATED = 3
 
-@dataclass
+class DriverMessage:
+    """Messages from the Kernel to the Driver."""
+    __slots__ = ()
+
+    # Tag identifying the message type on the wire.
+    tag: ClassVar[int]
+
+    def payload(self) -> bytes:
+        """Body of the message on the wire."""
+        return b""
+
+    def fds(self) -> List[int]:
+        """File descriptors passed along with the message."""
+        return []
+
+@dataclass(slots=True, frozen=True)
 class CheckpointCreated(DriverMessage):
     """Message indicating a checkpoint was successfully created."""
+    tag = CHECKPOINT_CREATED
+    _PAYLOAD = struct.Struct("<i")
 
     # Pid of the newly created checkpoint process.
     checkpoint_pid: int
+    # Eventfd that restores the checkpoint process when written to.
+    wakeup_fd: int
+    # Pidfd referring to the checkpoint process.
+    pidfd: int
+
+    def payload(self) -> bytes:
+        return self._PAYLOAD.pack(self.checkpoint_pid)
+
+    def fds(self) -> List[int]:
+        return [self.wakeup_fd, self.pidfd]
+
+@dataclass(slots=True, frozen=True)
+class CheckpointsCreated(DriverMessage):
+    """Message indicating a batch of checkpoints was successfully created."""
+    tag = CHECKPOINTS_CREATED
 
+    # Pids of the newly created checkpoint processes, oldest first.
+    checkpoint_pids: Tuple[int, ...]
+    # Eventfds that restore each checkpoint process when written to.
+    wakeup_fds: Tuple[int, ...]
+    # Pidfds referring to each checkpoint process.
+    pidfds: Tuple[int, ...]
+
+    def payload(self) -> bytes:
+        return struct.pack(f"<{len(self.checkpoint_pids)}i", *self.checkpoint_pids)
+
+    def fds(self) -> List[int]:
+        return [*self.wakeup_fds, *self.pidfds]
+
+@dataclass(slots=True, frozen=True)
 class CheckpointRestored(DriverMessage):
-    pass
+    tag = CHECKPOINT_RESTORED
 
+@dataclass(slots=True, frozen=True)
 class Ack(DriverMessage):
-    pass
+    tag = ACK
+
+# Messages without a payload are immutable, so a single instance of each
+# is shared by every decode().
+_PAYLOADLESS_MESSAGES = {
+    CHECKPOINT_RESTORED: CheckpointRestored(),
+    ACK: Ack(),
+}
+
+def decode(tag: int, payload: bytes, fds: List[int]) -> DriverMessage:
+    """Reconstruct a DriverMessage from its tag, payload and file descriptors."""
+    if tag == CHECKPOINT_CREATED:
+        (checkpoint_pid,) = CheckpointCreated._PAYLOAD.unpack(payload)
+        wakeup_fd, pidfd = fds
+        return CheckpointCreated(checkpoint_pid, wakeup_fd, pidfd)
+    if tag == CHECKPOINTS_CREATED:
+        num_checkpoints = len(payload) // 4
+        checkpoint_pids = struct.unpack(f"<{num_checkpoints}i", payload)
+        # The wakeup eventfds come first, followed by the pidfds.
+        return CheckpointsCreated(
+            checkpoint_pids,
+            tuple(fds[:num_checkpoints]),
+            tuple(fds[num_checkpoints:]),
+        )
+
+    msg = _PAYLOADLESS_MESSAGES.get(tag)
+    if msg is None:
+        raise ValueError(f"Fatal error: unknown DriverMessage tag {tag}")
+    return msg
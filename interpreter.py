@@ -8,28 +8,58 @@ the interpreter. The Driver provides two main functions:
               before the execution of the last cell.
 
 Each interpreter has one Driver process and one current Kernel process.
-The Driver and the Kernel perform interprocess communication via Pipes.
+The Driver and the Kernel perform interprocess communication over a
+Unix socket pair. Each message is sent as a frame consisting of a
+struct-packed header (frame length and message tag) followed by the
+message payload, so no pickling is involved. Both are handed to a single
+sendmsg() call, without first being copied into one buffer.
 
 Each time exec_cell() is called on the Driver, it first snapshots the
 current Kernel process. This snapshot is achieved by calling fork() on
 the Kernel process and immediately putting the child process to sleep
-to wait for a SIGCONT signal. The pid of the child process is maintained
-by the Driver in a buffer of snapshot pids. After the snapshot, the code
-cell is executed in the current Kernel.
+on a read from an eventfd created for it. The pid of the child process,
+its eventfd and a pidfd referring to it (both passed to the Driver over
+the socket) are maintained by the Driver in a buffer of snapshots. After
+the snapshot, the code cell is executed in the current Kernel.
+
+To keep fork() off the critical path of exec_cell(), the Kernel forks the
+snapshot ahead of time: right after replying to the Driver, it forks a
+pending snapshot of its current state, which is simply handed off to the
+Driver when the next cell is executed.
+
+Right before each fork(), the Kernel collects and then freezes its
+garbage-collected heap (gc.freeze()), so that later collections in the
+current Kernel do not write to, and thus copy, the pages it shares with
+its snapshots. The first such freeze happens before the Kernel handles
+any message, covering everything created at startup. The Kernel never
+calls gc.unfreeze(): a snapshot may be restored at any time, and it is
+restored with the same frozen heap it was forked with.
+
+To bound the number of sleeping snapshots, the Driver prunes them so that
+their spacing grows exponentially with their age: roughly, the snapshots
+taken 1, 2, 4, 8, ... cells ago are kept, along with the very first one.
+Undoing past the most recent snapshots thus goes back several cells at
+once, while only O(log n) snapshots are kept after n cells.
 
 To restore a snapshot (i.e. when undo() is called):
     - the current Kernel is SIGKILLed,
-    - SIGCONT is sent to the latest snapshot pid, and
+    - the latest snapshot's eventfd is written to, waking it up, and
     - the restored snapshot Kernel is treated as the new current Kernel.
 
 At any time, only the current Kernel process will read from the Kernel
-end of a Pipe that the Driver writes to (since all snapshots are asleep).
+end of the socket that the Driver writes to (since all snapshots are asleep).
 """
-from multiprocessing import Process, Pipe
+import gc
 import signal
 import os
+import select
+import socket
+import struct
 import sys
-from typing import Optional
+from array import array
+from collections import OrderedDict
+from types import CodeType
+from typing import Dict, List, Optional, Sequence, Set, Tuple
 from dataclasses import dataclass
 from enum import Enum
 from abc import ABC
@@ -40,96 +70,394 @@ import logging
 # Special REPL token that tells the interpreter to undo the last command.
 _UNDO_REPL_TOKEN = "!!"
 
+# Header of each frame sent between the Driver and the Kernel: the length
+# of the rest of the frame (tag + payload), followed by the message tag.
+_FRAME_HEADER = struct.Struct("<IB")
+
+# Buffer that frame headers are received into.
+_frame_header_buf = bytearray(_FRAME_HEADER.size)
+
+# Maximum number of file descriptors passed along with a single frame.
+# Linux accepts at most SCM_MAX_FD (253) of them in a single message.
+_MAX_FRAME_FDS = 252
+
+# Maximum number of cells executed by a single CheckpointAndExecBatch,
+# each of which passes two file descriptors back to the Driver.
+_MAX_BATCH_CELLS = _MAX_FRAME_FDS // 2
+
+# Maximum number of compiled cells cached by a Kernel.
+_CODE_CACHE_SIZE = 256
+
+# Script run by a freshly spawned Python interpreter to become a Kernel.
+_KERNEL_MAIN = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "kernel_main.py"
+)
+
+def _send(
+    sock: socket.socket, tag: int, payload: bytes, fds: Sequence[int] = ()
+) -> None:
+    """Send a frame with the given tag and payload over the socket.
+
+    The given file descriptors are passed along with the frame."""
+    header = _FRAME_HEADER.pack(len(payload) + 1, tag)
+    # The header and payload are gathered by a single sendmsg() rather than
+    # concatenated, so the payload (e.g. a large cell) is not copied.
+    ancdata = []
+    if fds:
+        # The file descriptors travel as ancillary data attached to the
+        # start of the frame.
+        ancdata.append((socket.SOL_SOCKET, socket.SCM_RIGHTS, array("i", fds)))
+    nbytes = sock.sendmsg([header, payload], ancdata)
+
+    # Send whatever did not fit in the socket buffer.
+    if nbytes < len(header):
+        sock.sendall(header[nbytes:])
+        nbytes = len(header)
+    sock.sendall(memoryview(payload)[nbytes - len(header):])
+
+def _recv_exactly(sock: socket.socket, buf: memoryview) -> None:
+    """Fill the given buffer with bytes received from the socket."""
+    while buf:
+        nbytes = sock.recv_into(buf)
+        if nbytes == 0:
+            raise EOFError("Socket closed by peer.")
+        buf = buf[nbytes:]
+
+def _recv(sock: socket.socket) -> Tuple[int, bytearray, List[int]]:
+    """Receive a frame from the socket.
+
+    The frame's tag and payload are returned, along with any file
+    descriptors passed with it."""
+    header = memoryview(_frame_header_buf)
+    fds = array("i")
+    nbytes, ancdata, _, _ = sock.recvmsg_into(
+        [header], socket.CMSG_SPACE(_MAX_FRAME_FDS * fds.itemsize)
+    )
+    if nbytes == 0:
+        raise EOFError("Socket closed by peer.")
+    for cmsg_level, cmsg_type, data in ancdata:
+        if cmsg_level == socket.SOL_SOCKET and cmsg_type == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - (len(data) % fds.itemsize)])
+    _recv_exactly(sock, header[nbytes:])
+
+    length, tag = _FRAME_HEADER.unpack(_frame_header_buf)
+    payload = bytearray(length - 1)
+    _recv_exactly(sock, memoryview(payload))
+    return tag, payload, list(fds)
+
+@dataclass
+class Snapshot:
+    """A sleeping snapshot of the Kernel."""
+
+    # Pid of the snapshot process.
+    pid: int
+    # Eventfd that the snapshot process sleeps on. Writing to it
+    # restores the snapshot.
+    wakeup_fd: int
+    # Pidfd referring to the snapshot process.
+    pidfd: int
+
+    def kill(self):
+        """SIGKILL the snapshot process."""
+        signal.pidfd_send_signal(self.pidfd, signal.SIGKILL)
+
+    def close(self):
+        """Close the file descriptors referring to the snapshot."""
+        os.close(self.wakeup_fd)
+        os.close(self.pidfd)
+
+def _keep_checkpoint(num_cells_before: int, num_cells: int) -> bool:
+    """Whether to keep a checkpoint that was taken after the given number
+    of cells had been executed, now that num_cells have been executed.
+
+    A checkpoint is kept for 2 ** (k + 1) cells, where 2 ** k is the largest
+    power of two dividing the number of cells before it, so exactly one
+    checkpoint is kept in each window of 2 ** (k + 1) cells. A checkpoint
+    that is dropped would never be kept again later on.
+    """
+    if num_cells_before == 0:
+        # The checkpoint of the initial Kernel is always kept.
+        return True
+    lowest_bit = num_cells_before & -num_cells_before
+    return num_cells - num_cells_before <= 2 * lowest_bit
+
+def _wait_for_exit(snapshots: List[Snapshot]) -> None:
+    """Wait until all of the given snapshot processes have exited."""
+    poller = select.poll()
+    for snapshot in snapshots:
+        # A pidfd becomes readable once its process has exited.
+        poller.register(snapshot.pidfd, select.POLLIN)
+
+    remaining = len(snapshots)
+    while remaining > 0:
+        for pidfd, _ in poller.poll():
+            poller.unregister(pidfd)
+            remaining -= 1
+
 class KernelClient:
     """Client to interact with a Kernel process."""
 
-    def __init__(self, kernel_pid: int, kernel_pipe: Pipe):
+    def __init__(self, kernel_pid: int, kernel_sock: socket.socket):
         # Pid of the Kernel
         self.kernel_pid = kernel_pid
-        # Pipe to communicate with the Kernel
-        self.kernel_pipe = kernel_pipe
+        # Socket to communicate with the Kernel
+        self.kernel_sock = kernel_sock
 
     def send_message(self, msg: kernel_message.KernelMessage) -> driver_message.DriverMessage:
         """Send a message to the Kernel."""
-        self.kernel_pipe.send(msg)
-        return self.kernel_pipe.recv()
+        _send(self.kernel_sock, msg.tag, msg.payload())
+        return self.recv_message()
+
+    def recv_message(self) -> driver_message.DriverMessage:
+        """Receive a message from the Kernel."""
+        tag, payload, fds = _recv(self.kernel_sock)
+        return driver_message.decode(tag, payload, fds)
 
 class Kernel:
     """Maintains state generated by the execution of code cells."""
 
-    def __init__(self, driver_pid: int, driver_pipe: Pipe):
+    def __init__(self, driver_pid: int, driver_sock: socket.socket):
         # Pid of the Kernel process
         self.pid = os.getpid()
         # Pid of the Driver communicating with this Kernel.
         self.driver_pid = driver_pid
-        # Pipe to communicate with the Driver.
-        self.driver_pipe = driver_pipe
-
-        # Environment in which cells are executed. These environments maintain
-        # any state that is generated by executing cells.
-        self.local_env = dict()
-        self.global_env = dict()
+        # Socket to communicate with the Driver.
+        self.driver_sock = driver_sock
+
+        # Namespace in which cells are executed, which maintains any state
+        # generated by executing cells. Cells run at module level, as in
+        # a script run as __main__: a separate locals dict would give them
+        # class-body scoping, hiding their names from the functions they
+        # define.
+        self.global_env = {"__builtins__": __builtins__, "__name__": "__main__"}
+
+        # Compiled code of recently executed cells, least recently used
+        # first. Cells such as print(x) are often executed again later on.
+        # (A cell re-executed after undoing it is not found here, since the
+        # restored snapshot was forked before that cell was received.)
+        self.code_cache: OrderedDict[str, CodeType] = OrderedDict()
+
+        # Snapshot of the current Kernel state, forked ahead of time and
+        # handed off to the Driver at the next checkpoint.
+        self.pending_snapshot: Optional[Snapshot] = None
+
+        # Pids of the snapshots forked by this Kernel that have not been
+        # reaped yet. Other children, e.g. processes started by cells, are
+        # left for the cells to wait on.
+        self.snapshot_pids: Set[int] = set()
 
     def run(self):
         """Begin the Kernel's execution.
 
         The Kernel waits for messages from the Driver and reacts to them."""
+        # Handlers for each KernelMessage, keyed by tag.
+        handlers = {
+            kernel_message.CELL_INPUT: self._handle_cell_input,
+            kernel_message.CHECKPOINT: self._handle_checkpoint,
+            kernel_message.CHECKPOINT_AND_EXEC: self._handle_checkpoint_and_exec,
+            kernel_message.SHUTDOWN: self._handle_shutdown,
+            kernel_message.CHECKPOINT_AND_EXEC_BATCH: (
+                self._handle_checkpoint_and_exec_batch
+            ),
+        }
+
+        self.prewarm()
         while True:
-            msg: kernel_message.KernelMessage = self.driver_pipe.recv()
-            if isinstance(msg, kernel_message.CellInput):
-                self.next(msg.cell)
-                self.driver_pipe.send(driver_message.Ack())
-            elif isinstance(msg, kernel_message.Checkpoint):
-                checkpoint_pid = self.checkpoint()
-                if checkpoint_pid is None:
-                    # This branch is taken by a restored snapshot Kernel.
-                    continue
-
-                self.driver_pipe.send(
-                    driver_message.CheckpointCreated(checkpoint_pid)
-                )
-            elif isinstance(msg, kernel_message.Shutdown):
-                logging.debug(f"Kernel at pid {self.pid} shutting down.")
-                self.driver_pipe.send(driver_message.Ack())
-                sys.exit(0)
-            else:
-                raise ValueError(f"Fatal error: uknown KernelMessage {msg.__class__}")
-
-    def checkpoint(self) -> Optional[int]:
+            try:
+                tag, payload, _ = _recv(self.driver_sock)
+            except EOFError:
+                # The Driver exited without shutting down its Kernels. Kill
+                # this Kernel's process group, i.e. this Kernel along with
+                # every snapshot, so that no snapshot sleeps forever.
+                os.killpg(0, signal.SIGKILL)
+            handler = handlers.get(tag)
+            if handler is None:
+                raise ValueError(f"Fatal error: unknown KernelMessage tag {tag}")
+            handler(payload)
+
+    def _handle_cell_input(self, payload: bytearray):
+        self.next(payload.decode())
+        self.send_message(driver_message.Ack())
+        # The pending snapshot no longer matches the Kernel state.
+        self.discard_pending_snapshot()
+        self.prewarm()
+
+    def _handle_checkpoint(self, payload: bytearray):
+        self.hand_off_pending_snapshot()
+        self.prewarm()
+
+    def _handle_checkpoint_and_exec(self, payload: bytearray):
+        # The reply is only sent once the cell has run, so that the
+        # Driver does not return before the cell's side effects
+        # (e.g. printed output) have happened.
+        self.next(payload.decode())
+        self.hand_off_pending_snapshot()
+        self.prewarm()
+
+    def _handle_checkpoint_and_exec_batch(self, payload: bytearray):
+        snapshots = []
+        for i, cell in enumerate(kernel_message.unpack_cells(payload)):
+            # The first cell is checkpointed by the pending snapshot
+            # forked after the previous reply.
+            if i > 0 and self.prewarm():
+                # This is a snapshot taken in the middle of the batch, now
+                # restored. The rest of the batch is not run, and the
+                # snapshots of its earlier cells belong to the Driver.
+                for snapshot in snapshots:
+                    snapshot.close()
+                return
+            snapshots.append(self.pending_snapshot)
+            self.pending_snapshot = None
+            self.next(cell)
+
+        self.send_message(
+            driver_message.CheckpointsCreated(
+                tuple(snapshot.pid for snapshot in snapshots),
+                tuple(snapshot.wakeup_fd for snapshot in snapshots),
+                tuple(snapshot.pidfd for snapshot in snapshots),
+            )
+        )
+        for snapshot in snapshots:
+            snapshot.close()
+        self.prewarm()
+
+    def _handle_shutdown(self, payload: bytearray):
+        logging.debug(f"Kernel at pid {self.pid} shutting down.")
+        self.discard_pending_snapshot()
+        self.send_message(driver_message.Ack())
+        # Skip interpreter finalization, which is wasted work for a Kernel
+        # whose state is being discarded. Cell output is already flushed.
+        os._exit(0)
+
+    def send_message(self, msg: driver_message.DriverMessage):
+        """Send a message to the Driver."""
+        _send(self.driver_sock, msg.tag, msg.payload(), msg.fds())
+
+    def hand_off_pending_snapshot(self):
+        """Send the pending snapshot to the Driver as a new checkpoint."""
+        snapshot = self.pending_snapshot
+        self.pending_snapshot = None
+        self.send_message(
+            driver_message.CheckpointCreated(
+                snapshot.pid, snapshot.wakeup_fd, snapshot.pidfd
+            )
+        )
+        # The Driver now holds its own copies of the file descriptors.
+        snapshot.close()
+
+    def discard_pending_snapshot(self):
+        """Kill the pending snapshot."""
+        snapshot = self.pending_snapshot
+        self.pending_snapshot = None
+        snapshot.kill()
+        snapshot.close()
+
+    def prewarm(self) -> bool:
+        """Fork the pending snapshot of the current Kernel state.
+
+        This is done right after replying to the Driver, so the cost of
+        fork() is paid while the Driver waits on user input rather than
+        on the critical path of the next checkpoint. Only one snapshot is
+        kept pending, since any cell execution makes it stale.
+
+        Returns whether the current process is a snapshot that has since
+        been restored.
+        """
+        restored = False
+        while True:
+            snapshot = self.checkpoint()
+            if snapshot is not None:
+                self.pending_snapshot = snapshot
+                return restored
+            # This branch is taken by a restored snapshot Kernel, which
+            # needs a pending snapshot of its own restored state.
+            restored = True
+
+    def checkpoint(self) -> Optional[Snapshot]:
         """Checkpoint the current Kernel.
 
         The current Kernel process is forked. If the current process
-        is the parent, the child pid is returned; otherwise, if it
-        is the child, None is returned.
+        is the parent, the child snapshot is returned; otherwise, if it
+        is the child, None is returned once the snapshot is restored.
+
+        The snapshot is deliberately the child rather than the parent.
+        Keeping the current Kernel as the root of a flat process tree
+        keeps the cost of fork() constant; were each snapshot instead the
+        parent of the next Kernel, every fork() would happen at the end
+        of an ever-longer chain of ancestors, and its cost grows with
+        the length of that chain.
+
+        A full fork() is needed, page-table copy included: a child that
+        shares the Kernel's address space (vfork(), or clone() with
+        CLONE_VM) would see every later write made by the Kernel, so it
+        would not be a snapshot at all.
         """
-        current_pid = os.getpid()
+        # Move every object that survives a collection into the permanent
+        # generation, which later collections never traverse. Otherwise the
+        # next full collection in the current Kernel rewrites the GC header
+        # of every container object, copying nearly every page of the heap
+        # that is shared with the snapshot. The flip side is that reference
+        # cycles among frozen objects are never collected.
+        gc.collect()
+        gc.freeze()
+
+        # Reap the snapshots forked by this Kernel that have since been
+        # killed, e.g. pruned by the Driver.
+        for snapshot_pid in list(self.snapshot_pids):
+            if os.waitpid(snapshot_pid, os.WNOHANG)[0] != 0:
+                self.snapshot_pids.remove(snapshot_pid)
+
+        wakeup_fd = os.eventfd(0, os.EFD_CLOEXEC)
         pid = os.fork()
         if pid == 0:
             # This proc is the child.
-            # The child process sleeps until it is restored.
-
-            # TODO using signal.SIG_IGN / signal.SIG_DFL instead
-            # of the no-op lambda doesn't work here. Why?
-            signal.signal(signal.SIGCONT, lambda signum, stack: None)
-            signal.pause()
+            # The child process sleeps until the Driver restores it by
+            # writing to the eventfd.
+            os.eventfd_read(wakeup_fd)
+            os.close(wakeup_fd)
 
             self.pid = os.getpid()
+            # The snapshots forked so far are children of the Kernel that
+            # forked this one, not of this one.
+            self.snapshot_pids.clear()
 
             logging.debug(f"Kernel with pid {self.pid} is restored")
-            self.driver_pipe.send(driver_message.CheckpointRestored())
+            self.send_message(driver_message.CheckpointRestored())
         else:
             # This proc is the parent.
-            # We return the child pid.
-            return pid
+            # We return the child snapshot.
+            self.snapshot_pids.add(pid)
+            return Snapshot(pid, wakeup_fd, os.pidfd_open(pid))
 
     def next(self, cell: str):
         """Execute the next cell of code in the Kernel."""
         # TODO add error handling when exec() throws an exception
-        exec(cell, self.global_env, self.local_env)
-
-def spawn_new_kernel(driver_pid: int, driver_pipe: Pipe):
+        exec(self.compile_cell(cell), self.global_env)
+
+        # Cell output is written by the Kernel straight to the stdout and
+        # stderr it inherited, without passing through the Driver. Flush it
+        # before replying to the Driver, so it is not printed after the next
+        # prompt, and before the next fork(), so buffered output is not
+        # copied into the snapshot and printed again if it is restored.
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+    def compile_cell(self, cell: str) -> CodeType:
+        """Compile the given cell, reusing its cached code if possible."""
+        code = self.code_cache.get(cell)
+        if code is not None:
+            self.code_cache.move_to_end(cell)
+            return code
+
+        code = compile(cell, "<cell>", "exec")
+        self.code_cache[cell] = code
+        if len(self.code_cache) > _CODE_CACHE_SIZE:
+            self.code_cache.popitem(last=False)
+        return code
+
+def spawn_new_kernel(driver_pid: int, driver_sock: socket.socket):
     """Launch function for a new Kernel."""
-    kernel = Kernel(driver_pid, driver_pipe)
+    kernel = Kernel(driver_pid, driver_sock)
     kernel.run()
 
 class Driver:
@@ -138,66 +466,146 @@ class Driver:
     def __init__(self):
         # The Driver process' pid.
         self.pid = os.getpid()
-        # Pids of checkpointed Kernels.
-        self.checkpoint_pids = []
-
-        # Start up Kernel child process
-        parent_pipe, child_pipe = Pipe()
-        kernel_proc = Process(target=spawn_new_kernel, args=(self.pid, child_pipe))
-        kernel_proc.start()
-
+        # Snapshots of checkpointed Kernels, oldest first, keyed by the
+        # number of cells that had been executed when they were taken.
+        self.checkpoints: Dict[int, Snapshot] = {}
+        # Number of cells executed to reach the current Kernel state.
+        self.num_cells = 0
+
+        # Start up Kernel child process. It is spawned as a fresh Python
+        # interpreter rather than forked from the Driver, so that it does not
+        # inherit (and later fork along with every snapshot) whatever state
+        # the Driver holds. It leads a new process group, which every
+        # snapshot forked from it joins as well, so that they can all be
+        # killed at once.
+        parent_sock, child_sock = socket.socketpair(socket.AF_UNIX)
+        child_sock.set_inheritable(True)
+        kernel_pid = os.posix_spawn(
+            sys.executable,
+            [
+                sys.executable,
+                _KERNEL_MAIN,
+                str(self.pid),
+                str(child_sock.fileno()),
+            ],
+            os.environ,
+            # Cells cannot read from the Driver's stdin.
+            file_actions=[(os.POSIX_SPAWN_OPEN, 0, os.devnull, os.O_RDONLY, 0)],
+            setpgroup=0,
+        )
+        child_sock.close()
+
+        # Process group of the Kernel and all of its snapshots.
+        self.kernel_pgid = kernel_pid
         # Client to the current Kernel.
-        self.kernel_client = KernelClient(kernel_proc.pid, parent_pipe)
+        self.kernel_client = KernelClient(kernel_pid, parent_sock)
 
     def exec_cell(self, cell: str) -> None:
-        """Execute the given cell in the current Kernel."""
-        retmsg = self.kernel_client.send_message(kernel_message.Checkpoint())
-        self.checkpoint_pids.append(retmsg.checkpoint_pid)
-
-        self.kernel_client.send_message(kernel_message.CellInput(cell))
-        # TODO implement checkpoint pruning
+        """Execute the given cell in the current Kernel.
+
+        The Kernel is checkpointed and the cell executed in a single
+        round-trip with the Kernel."""
+        retmsg = self.kernel_client.send_message(
+            kernel_message.CheckpointAndExec(cell)
+        )
+        self.checkpoints[self.num_cells] = Snapshot(
+            retmsg.checkpoint_pid, retmsg.wakeup_fd, retmsg.pidfd
+        )
+        self.num_cells += 1
+        self.prune_checkpoints()
+
+    def exec_cells(self, cells: List[str]) -> None:
+        """Execute the given cells in order in the current Kernel.
+
+        The Kernel is checkpointed before each cell, as with exec_cell(),
+        but all the cells are sent in a single round-trip with the Kernel
+        (or one per _MAX_BATCH_CELLS cells). This suits scripted use; the
+        REPL executes cells one at a time."""
+        for start in range(0, len(cells), _MAX_BATCH_CELLS):
+            batch = tuple(cells[start:start + _MAX_BATCH_CELLS])
+            retmsg = self.kernel_client.send_message(
+                kernel_message.CheckpointAndExecBatch(batch)
+            )
+            for pid, wakeup_fd, pidfd in zip(
+                retmsg.checkpoint_pids, retmsg.wakeup_fds, retmsg.pidfds
+            ):
+                self.checkpoints[self.num_cells] = Snapshot(pid, wakeup_fd, pidfd)
+                self.num_cells += 1
+            self.prune_checkpoints()
+
+    def prune_checkpoints(self):
+        """SIGKILL the checkpoints that are no longer worth keeping."""
+        for num_cells_before in list(self.checkpoints):
+            if not _keep_checkpoint(num_cells_before, self.num_cells):
+                checkpoint = self.checkpoints.pop(num_cells_before)
+                checkpoint.kill()
+                checkpoint.close()
 
     def shutdown(self):
         """Shutdown the Driver and associated Kernels.
 
-        The current Kernel and all sleeping snapshots are SIGKILLed."""
-        for checkpoint_pid in self.checkpoint_pids:
-            # TODO is there a better way to do this?
-            os.kill(checkpoint_pid, signal.SIGKILL)
-
+        The current Kernel is shut down, then all sleeping snapshots are
+        SIGKILLed at once through their process group. This returns once
+        all snapshots have exited."""
         self.kernel_client.send_message(kernel_message.Shutdown())
 
+        try:
+            os.killpg(self.kernel_pgid, signal.SIGKILL)
+        except ProcessLookupError:
+            # No snapshots were left.
+            pass
+
+        _wait_for_exit(list(self.checkpoints.values()))
+        for checkpoint in self.checkpoints.values():
+            checkpoint.close()
+        self.checkpoints.clear()
+
+        # Reap the initial Kernel, the only one that is a child of the Driver.
+        os.waitpid(self.kernel_pgid, 0)
+
     def undo(self):
         """Undo the last operation made on the Kernel.
 
         Explicitly, this restores the last snapshot that was captured
-        right before the execution of the latest cell of code."""
-        if len(self.checkpoint_pids) == 0:
+        right before the execution of the latest cell of code. If that
+        snapshot was pruned, the latest snapshot still kept is restored,
+        undoing several cells at once."""
+        if len(self.checkpoints) == 0:
             raise Error("Nothing to undo.")
 
-        checkpoint_pid = self.checkpoint_pids.pop()
+        self.num_cells, checkpoint = self.checkpoints.popitem()
 
         # Shutdown the current Kernel.
         ack = self.kernel_client.send_message(kernel_message.Shutdown())
 
         # Restore the snapshotted Kernel.
-        self.kernel_client.kernel_pid = checkpoint_pid
-        os.kill(checkpoint_pid, signal.SIGCONT)
-        msg = self.kernel_client.kernel_pipe.recv()
+        self.kernel_client.kernel_pid = checkpoint.pid
+        os.eventfd_write(checkpoint.wakeup_fd, 1)
+        checkpoint.close()
+        msg = self.kernel_client.recv_message()
         assert isinstance(msg, driver_message.CheckpointRestored)
 
 
 def main():
     driver = Driver()
-    signal.signal(signal.SIGTERM, lambda signum, stack: driver.shutdown())
+    # Exit through the finally clause below, which shuts the Driver down.
+    signal.signal(signal.SIGTERM, lambda signum, stack: sys.exit(0))
 
-    while True:
-        cell = input(">> ").strip()
+    try:
+        while True:
+            cell = input(">> ").strip()
 
-        if cell == _UNDO_REPL_TOKEN:
-            driver.undo()
-        else:
-            driver.exec_cell(cell)
+            if cell == _UNDO_REPL_TOKEN:
+                driver.undo()
+            else:
+                driver.exec_cell(cell)
+    except (EOFError, KeyboardInterrupt):
+        # Ctrl-D or Ctrl-C ends the session.
+        print()
+    finally:
+        # The Kernel and its snapshots are in their own process group, which
+        # the terminal does not signal, so they must be shut down explicitly.
+        driver.shutdown()
 
 if __name__ == "__main__":
     main()
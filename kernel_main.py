@@ -0,0 +1,14 @@
+"""Entrypoint of the initial Kernel process spawned by the Driver.
+
+Usage: python kernel_main.py DRIVER_PID DRIVER_SOCK_FD
+
+The Driver's end of the socket pair is inherited as DRIVER_SOCK_FD.
+"""
+import socket
+import sys
+from interpreter import spawn_new_kernel
+
+if __name__ == "__main__":
+    driver_pid = int(sys.argv[1])
+    driver_sock = socket.socket(fileno=int(sys.argv[2]))
+    spawn_new_kernel(driver_pid, driver_sock)
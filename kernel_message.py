@@ -1,18 +1,77 @@
 from dataclasses import dataclass
-from abc import ABC, abstractmethod
+from typing import ClassVar, List, Tuple
+import struct
 
-class KernelMessage(ABC):
+# Tags identifying each type of KernelMessage on the wire.
+CELL_INPUT = 0
+CHECKPOINT = 1
+CHECKPOINT_AND_EXEC = 2
+SHUTDOWN = 3
+CHECKPOINT_AND_EXEC_BATCH = 4
+
+# Length prefix of each cell in a CheckpointAndExecBatch payload.
+_CELL_LENGTH = struct.Struct("<I")
+
+class KernelMessage:
     """Messages from the Driver to the Kernel."""
+    __slots__ = ()
+
+    # Tag identifying the message type on the wire.
+    tag: ClassVar[int]
 
-@dataclass
+    def payload(self) -> bytes:
+        """Body of the message on the wire."""
+        return b""
+
+@dataclass(slots=True, frozen=True)
 class CellInput(KernelMessage):
     """Execute a new cell of input."""
+    tag = CELL_INPUT
     cell: str
 
+    def payload(self) -> bytes:
+        return self.cell.encode()
+
+@dataclass(slots=True, frozen=True)
 class Checkpoint(KernelMessage):
     """Checkpoint the kernel."""
-    pass
+    tag = CHECKPOINT
 
+@dataclass(slots=True, frozen=True)
+class CheckpointAndExec(KernelMessage):
+    """Checkpoint the kernel, then execute a new cell of input."""
+    tag = CHECKPOINT_AND_EXEC
+    cell: str
+
+    def payload(self) -> bytes:
+        return self.cell.encode()
+
+@dataclass(slots=True, frozen=True)
 class Shutdown(KernelMessage):
     """Shutdown the Kernel receiving this message."""
-    pass
+    tag = SHUTDOWN
+
+@dataclass(slots=True, frozen=True)
+class CheckpointAndExecBatch(KernelMessage):
+    """Checkpoint the kernel before executing each of several cells."""
+    tag = CHECKPOINT_AND_EXEC_BATCH
+    cells: Tuple[str, ...]
+
+    def payload(self) -> bytes:
+        parts = []
+        for cell in self.cells:
+            encoded = cell.encode()
+            parts.append(_CELL_LENGTH.pack(len(encoded)))
+            parts.append(encoded)
+        return b"".join(parts)
+
+def unpack_cells(payload: bytes) -> List[str]:
+    """Recover the cells of a CheckpointAndExecBatch from its payload."""
+    cells = []
+    offset = 0
+    while offset < len(payload):
+        (length,) = _CELL_LENGTH.unpack_from(payload, offset)
+        offset += _CELL_LENGTH.size
+        cells.append(bytes(payload[offset:offset + length]).decode())
+        offset += length
+    return cells